@@ -6,10 +6,7 @@ def gaussian(x, mu, sig):
 	return np.exp(-np.power(x - mu, 2.) / (2 * np.power(sig, 2.)))
 
 def createModel(X, mu, sig, scale):
-	model = np.zeros_like(X)
-	for i, x in enumerate(X):
-		model[i] = gaussian(x, mu, sig) * scale
-	return model
+	return gaussian(X, mu, sig) * scale
 
 
 class Peak(object):
@@ -57,7 +54,7 @@ class Peak(object):
 		return self._peak
 
 	def elements(self):
-		return int(sum(self.Ty)) if self.Ty is not None else 0
+		return int(np.sum(self.Ty)) if self.Ty is not None else 0
 
 	# def poisson(self, x):
 	#    return np.exp(-self._mean) * (np.power(self._mean, x) / math.factorial(x))
@@ -86,8 +83,7 @@ class Peak(object):
 		self._peak = new_peak
 		self._stddev = new_stddev
 
-		for i, x in enumerate(self.Tx):
-			self.Ty[i] = gaussian(x, self._mean, self._stddev) * self._peak
+		np.multiply(gaussian(self.Tx, self._mean, self._stddev), self._peak, out=self.Ty)
 
 		return self.Ty
 
@@ -100,26 +96,43 @@ class Peak(object):
 
 		# This set the peak and adjusts the scaling factor accordingly
 		# and then updates the histogram represented by this specific peak
-		model = np.zeros_like(self.Tx)
-		for i, x in enumerate(self.Tx):
-			model[i] = gaussian(x, p[0], p[2]) * p[1]
+		model = createModel(self.Tx, p[0], p[2], p[1])
 
 		# Return the distance between the fitted peak and the actual histogram at each site
 		residuals = self.histogram - model
 
 		# We want to more heavily penalise all points which exceed the histogram
-		for i in range(len(residuals)):
-			d = residuals[i]
-			#if d < 0:
-			#	residuals[i] = d * 100
+		#residuals = np.where(residuals < 0, residuals * 100, residuals)
 
-			# Suppress residuals that come before fmin (we aren't interested in fitting to the error K=mers)
-			if i <= fmin:
-				residuals[i] /= np.power(fmin - i + 1, 10)
+		# Suppress residuals that come before fmin (we aren't interested in fitting to the error K=mers)
+		head = residuals[:fmin + 1]
+		head /= np.power(fmin - np.arange(len(head)) + 1.0, 10)
 
 		# The residual differences between the actual histogram and the model peak at each value of X
 		return residuals
 
+	def jacobian(self, p, fmin=0):
+		"""
+		Analytic jacobian of the residuals with respect to the mean, peak and stddev parameters
+		:param p: The parameters to use
+		:return: A len(Tx) by 3 array of partial derivatives
+		"""
+
+		z = (self.Tx - p[0]) / p[2]
+		g = gaussian(self.Tx, p[0], p[2])
+
+		# Residuals are histogram - model, hence the negation
+		jac = np.empty((len(self.Tx), 3))
+		jac[:, 0] = -p[1] * g * z / p[2]
+		jac[:, 1] = -g
+		jac[:, 2] = -p[1] * g * z * z / p[2]
+
+		# Apply the same suppression as the residuals before fmin
+		head = jac[:fmin + 1]
+		head /= np.power(fmin - np.arange(len(head)) + 1.0, 10)[:, None]
+
+		return jac
+
 	def optimise(self, histogram, fmin=0):
 		"""
 		Tries to fit this single guassian distribution to this point in the histogram as closely as possible
@@ -135,7 +148,7 @@ class Peak(object):
 		self.histogram = np.array(histogram)
 
 		# Create Tx and Ty (represents fitted histograms)
-		self.Tx = np.linspace(0, len(histogram) - 1, len(histogram))
+		self.Tx = np.arange(len(histogram), dtype=np.float64)
 		self.Ty = np.zeros_like(self.Tx)
 
 		# Make sure the current settings are up to date and the fitted histogram is based on these
@@ -156,7 +169,8 @@ class Peak(object):
 		upper_bounds.append(max((self._mean - 2.0) / 2.0, self._stddev))
 
 		# Set the optimal peak value that maximises the space under the histogram, without going over the borders.
-		res = optimize.least_squares(self.residuals, np.array(p).astype(np.float64), args=[fmin], bounds=(lower_bounds, upper_bounds), loss="soft_l1")
+		res = optimize.least_squares(self.residuals, np.array(p).astype(np.float64), args=[fmin], bounds=(lower_bounds, upper_bounds), loss="soft_l1",
+									jac=self.jacobian, method="trf", x_scale="jac")
 
 		# If all went well update the model with the optimised variables
 		if res.success:
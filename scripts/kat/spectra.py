@@ -1,36 +1,62 @@
 import abc
+import functools
 import sys
 import numpy as np
-import matplotlib
-import matplotlib.pyplot as plt
 from scipy import optimize
-from scipy.signal import argrelextrema
-import tabulate
+from scipy.signal import find_peaks
 
 try:
-	from .peak import Peak, gaussian, createModel
+	from .peak import Peak
 except:
-	from kat.peak import Peak, gaussian, createModel
+	from kat.peak import Peak
 
+def _sumGaussiansBroadcast(x, means, peaks, stddevs, y):
+	z = (x[:, None] - means) / stddevs
+	return np.sum(peaks * np.exp(-0.5 * z * z), axis=1, out=y)
 
-def smooth(x, window_len=3):
+
+@functools.lru_cache(maxsize=None)
+def _sumGaussiansJit():
 	"""
-	Smooths the histogram using a moving average
-	:param x: Histogram to smooth
-	:param window_len: Window length, larger value is smoother.  min (and default) is 3
-	:return: A smoothed version of x
+	Numba is optional.  If present the sum of gaussians is compiled into a single fused loop, which avoids the
+	len(x) * nb_peaks temporaries of the numpy broadcast.  Numba is only imported (and the kernel only compiled) the
+	first time a model is actually evaluated, so importing this module stays cheap.
+	:return: The compiled kernel, or None if numba isn't installed
 	"""
-	if x.ndim != 1:
-		raise ValueError("Smooth only accepts 1 dimension arrays.")
+	try:
+		from numba import njit
+	except ImportError:
+		return None
+
+	@njit(fastmath=True, cache=True)
+	def sum_gaussians(x, means, peaks, stddevs, y):
+		for i in range(x.shape[0]):
+			m = 0.0
+			for j in range(means.shape[0]):
+				z = (x[i] - means[j]) / stddevs[j]
+				m += peaks[j] * np.exp(-0.5 * z * z)
+			y[i] = m
+		return y
+
+	return sum_gaussians
+
 
-	if x.size < window_len or window_len < 3:
-		return x
+def _sumGaussians(x, means, peaks, stddevs, y):
+	kernel = _sumGaussiansJit() or _sumGaussiansBroadcast
+	return kernel(x, means, peaks, stddevs, y)
 
-	s = np.r_[x[window_len - 1:0:-1], x, x[-2:-window_len - 1:-1]]
-	w = np.ones(window_len, 'd')
-	y = np.convolve(w / w.sum(), s, mode='valid')
-	return y
 
+@functools.lru_cache(maxsize=8)
+def _frequencyAxis(n):
+	"""
+	Spectra of the same length (e.g. every column of a spectra-cn matrix) all share the same x values, so build these
+	once and hand out the same read-only array
+	:param n: Length of the histogram
+	:return: Read-only array of frequencies 0 .. n-1
+	"""
+	x = np.arange(n, dtype=np.float32)
+	x.flags.writeable = False
+	return x
 
 
 class Spectra(object):
@@ -40,8 +66,10 @@ class Spectra(object):
 		self.histogram = np.array(histogram)
 		self.k = k
 		self.peaks = None
-		self.Tx = np.linspace(0, len(histogram) - 1, len(histogram))
-		self.Ty = np.zeros_like(self.Tx)
+		self.Tx = _frequencyAxis(len(self.histogram))
+		self.Ty = np.zeros(len(self.histogram))
+		self._model_buf = np.empty_like(self.Tx)
+		self._Ty_buf = np.zeros(len(self.histogram))
 
 	@abc.abstractmethod
 	def _createInitialPeaks(self):
@@ -66,9 +94,14 @@ class Spectra(object):
 			new_stddev = params[i * 3 + 2]
 			self.peaks[i].updateModel(new_mean, new_peak, new_stddev)
 
-		self.Ty = np.zeros_like(self.Tx)
+		# Accumulate into a reusable buffer rather than allocating a fresh histogram each time
+		if len(self._Ty_buf) != len(self.Tx):
+			self._Ty_buf = np.zeros(len(self.Tx))
+		else:
+			self._Ty_buf.fill(0)
 		for p in self.peaks:
-			self.Ty += p.Ty
+			np.add(self._Ty_buf, p.Ty, out=self._Ty_buf)
+		self.Ty = self._Ty_buf
 
 		return self.Ty
 
@@ -78,22 +111,109 @@ class Spectra(object):
 		The parameters control how the shape of the scaled guassians representing each peak.
 		:params x: The x values, each of these will be applied to this function to create y which is of the same length
 		:param params: New set of parameters adjusted by the optimiser
-		:return: A numpy array of scalar values representing the difference between the model and reality at each X value
+		:return: A numpy array of scalar values representing the difference between the model and reality at each X value.
+		When x is Tx this is a scratch buffer owned by the spectra, which is overwritten by the next call, so copy it if
+		it needs to be kept.  Both optimisers only ever subtract it from the histogram straight away.
 		"""
 
 		if len(params) != len(self.peaks) * 3:
 			raise ValueError("Unexpected number of parameters")
 
-		# Recalculate the model based on information in the new parameters
-		y = np.zeros_like(x)
-		for i, peak in enumerate(self.peaks):
-			new_mean = params[i * 3]
-			new_peak = params[i * 3 + 1]
-			new_stddev = params[i * 3 + 2]
-			pdist = createModel(x, new_mean, new_stddev, new_peak)
-			y += pdist
+		# Recalculate the model based on information in the new parameters.  Each row of p holds the mean, peak and
+		# stddev of one peak.  The model is only evaluated in single precision, which is plenty given the poisson noise
+		# in the counts, and halves the memory traffic.  The optimiser itself still works in double precision.
+		# curve_fit hands us back a float64 copy of Tx, so if x holds the same values as Tx use Tx itself (and the
+		# scratch buffer) and avoid casting it down again on every call.
+		p = np.asarray(params, dtype=np.float32).reshape(-1, 3)
+		if x is self.Tx or np.array_equal(x, self.Tx):
+			x = self.Tx
+			y = self._model_buf
+		else:
+			x = np.asarray(x, dtype=np.float32)
+			y = np.empty_like(x)
+		return _sumGaussians(x, p[:, 0].copy(), p[:, 1].copy(), p[:, 2].copy(), y)
 
-		return y
+	def _createJacobian(self, x, *params):
+		"""
+		Analytic jacobian of _createModel with respect to each of the parameters, which saves the optimiser from
+		estimating it via finite differences (an extra model evaluation per parameter per iteration)
+		:params x: The x values the model is evaluated at
+		:param params: Current set of parameters adjusted by the optimiser
+		:return: A len(x) by len(params) array of partial derivatives
+		"""
+
+		if len(params) != len(self.peaks) * 3:
+			raise ValueError("Unexpected number of parameters")
+
+		p = np.asarray(params, dtype=np.float64).reshape(-1, 3)
+		z = (np.asarray(x, dtype=np.float64)[:, None] - p[:, 0]) / p[:, 2]
+		g = np.exp(-0.5 * z * z)
+		ag = p[:, 1] * g
+
+		jac = np.empty((len(x), len(params)))
+		jac[:, 0::3] = ag * z / p[:, 2]		# d/d mean
+		jac[:, 1::3] = g					# d/d peak
+		jac[:, 2::3] = ag * z * z / p[:, 2]	# d/d stddev
+		return jac
+
+	def _levenbergMarquardt(self, x, y, params, lower_bounds, upper_bounds, max_iter=200, tol=1e-8):
+		"""
+		Minimal levenberg-marquardt least squares fit of _createModel to y, keeping the parameters within bounds by
+		projecting each step back onto them.  With so few parameters the normal equations are tiny, so this avoids
+		the per iteration overhead of the general purpose scipy solvers.
+		:params x: The x values the model is evaluated at
+		:param y: The histogram to fit to
+		:param params: Initial set of parameters
+		:param lower_bounds: Lower bound for each parameter
+		:param upper_bounds: Upper bound for each parameter
+		:param max_iter: Maximum number of iterations before giving up
+		:param tol: Relative change in parameters or cost below which we consider the fit converged
+		:return: The optimised parameters, or None if the fit did not converge
+		"""
+
+		params = np.clip(np.asarray(params, dtype=np.float64), lower_bounds, upper_bounds)
+		res = y - self._createModel(x, *params)
+		cost = res @ res
+		damping = 1e-3
+
+		for _ in range(max_iter):
+			jac = self._createJacobian(x, *params)
+			jtj = jac.T @ jac
+			jtr = jac.T @ res
+			scale = np.maximum(np.diag(jtj), np.finfo(np.float64).eps)
+
+			# Parameters sitting on a bound that are being pushed further against it are held fixed for this iteration,
+			# otherwise projecting the step back onto the bounds cripples the progress of all the other parameters
+			free = ~(((params <= lower_bounds) & (jtr < 0)) | ((params >= upper_bounds) & (jtr > 0)))
+			jtj_free = jtj[np.ix_(free, free)]
+			step = np.zeros_like(params)
+
+			# Keep increasing the damping until we find a step that improves the fit.  If we can't find one then we
+			# are already at the minimum (at least within the bounds).
+			while True:
+				try:
+					step[free] = np.linalg.solve(jtj_free + damping * np.diag(scale[free]), jtr[free])
+				except np.linalg.LinAlgError:
+					return None
+				new_params = np.clip(params + step, lower_bounds, upper_bounds)
+				new_res = y - self._createModel(x, *new_params)
+				new_cost = new_res @ new_res
+				if not np.isfinite(new_cost):
+					return None
+				if new_cost < cost:
+					break
+				damping *= 10.0
+				if damping > 1e10:
+					return params
+
+			converged = np.linalg.norm(new_params - params) <= tol * (np.linalg.norm(params) + tol) or \
+						cost - new_cost <= tol * cost
+			params, res, cost = new_params, new_res, new_cost
+			damping = max(damping / 10.0, 1e-12)
+			if converged:
+				return params
+
+		return None
 
 	def optimise(self, fmin=0):
 		"""
@@ -104,36 +224,46 @@ class Spectra(object):
 			print("Can't optimise peaks because none are defined.", end="", flush=True)
 			return
 
-		params = []
-		lower_bounds = []
-		upper_bounds = []
-		for p in self.peaks:
-			params.append(p.mean())
-			lower_bounds.append(p.mean() - 1.0)
-			upper_bounds.append(p.mean() + 1.0)
-			params.append(p.peak())
-			lower_bounds.append(0.0)
-			upper_bounds.append(p.peak())
-			params.append(p.stddev())
-			stddev_lower = p.stddev() - np.sqrt(p.stddev())
-			stddev_upper = max(min((p.mean() - 2.0) / 2.0, p.stddev() + np.sqrt(p.stddev())), p.stddev()+0.01)
-			lower_bounds.append(stddev_lower)	# Make sure we can't get massively smaller
-			upper_bounds.append(stddev_upper)	# Make sure we can't get too much bigger or make peak extend past 0 freq
-
-		# Reset Tx and Ty in case the histogram has been modified
-		self.Tx = np.linspace(0, len(self.histogram) - 1, len(self.histogram))
+		# Pull the current state of each peak out into arrays once, rather than querying every peak for every bound
+		nb_peaks = len(self.peaks)
+		mu = np.fromiter((p.mean() for p in self.peaks), float, count=nb_peaks)
+		peak = np.fromiter((p.peak() for p in self.peaks), float, count=nb_peaks)
+		sig = np.fromiter((p.stddev() for p in self.peaks), float, count=nb_peaks)
+
+		# Make sure the stddev can't get massively smaller, or too much bigger, or make the peak extend past 0 freq
+		stddev_lower = sig - np.sqrt(sig)
+		stddev_upper = np.maximum(np.minimum((mu - 2.0) / 2.0, sig + np.sqrt(sig)), sig + 0.01)
+
+		# Parameters are interleaved as (mean, peak, stddev) triplets for each peak
+		params = np.column_stack((mu, peak, sig)).ravel()
+		lower_bounds = np.column_stack((mu - 1.0, np.zeros(nb_peaks), stddev_lower)).ravel()
+		upper_bounds = np.column_stack((mu + 1.0, peak, stddev_upper)).ravel()
+
+		# Reset Tx in case the histogram has been resized
+		if len(self.Tx) != len(self.histogram):
+			self.Tx = _frequencyAxis(len(self.histogram))
+			self._model_buf = np.empty_like(self.Tx)
 
 		# Suppress error k-mers
-		fitcurve = np.array(self.histogram)
-		for i in range(len(fitcurve)):
-			if i <= fmin:
-				fitcurve[i] /= np.power(fmin - i + 1, 6)
+		fitcurve = np.array(self.histogram, dtype=np.float64)
+		head = fitcurve[:fmin + 1]
+		head /= np.power(fmin - np.arange(len(head)) + 1.0, 6)
+
+		# Nothing to fit if every peak is locked at zero height or there is no content left in the histogram, so just
+		# build the model from the peaks as they are rather than have the optimiser run a trivial minimisation.
+		if np.all(upper_bounds[1::3] - lower_bounds[1::3] < 1e-12) or fitcurve.max(initial=0) <= 0:
+			self._updateModel(params)
+			return
 
-		# Fit model to real histogram
-		res = optimize.curve_fit(self._createModel, self.Tx, fitcurve, p0=params, bounds=(np.array(lower_bounds), np.array(upper_bounds)))
+		# Fit model to real histogram.  There are only a handful of parameters so try our own levenberg-marquardt first,
+		# and only fall back to the general purpose (and much heavier) scipy solver if that doesn't converge.
+		fitted = self._levenbergMarquardt(self.Tx, fitcurve, params, lower_bounds, upper_bounds)
+		if fitted is None:
+			fitted = optimize.curve_fit(self._createModel, self.Tx, fitcurve, p0=params, bounds=(lower_bounds, upper_bounds),
+										jac=self._createJacobian, method="trf", x_scale="jac")[0]
 
 		# Update the model with the optimised variables
-		self._updateModel(res[0])
+		self._updateModel(fitted)
 		return
 
 
@@ -163,18 +293,14 @@ class Spectra(object):
 					print(inst, file=sys.stderr)
 					# Just carry on from here... maybe the problem will fix itself...?
 
-			# For debugging
-			if False:
-				plt.plot(self.histogram, color='black')
-				for p_i, p in enumerate(self.peaks):
-					plt.plot(p.Ty)
-				plt.xlim(0, 70)
-				plt.ylim(0, 200000000)
-				plt.show()
-
 			# Remove any peaks that contain little to no content
 			self.peaks = list(filter(lambda p: p.elements() >= min_elements, self.peaks))
 
+			if not self.peaks:
+				if verbose:
+					print("done. No peaks left to fit")
+				return
+
 			if verbose:
 				print("done.")
 				print()
@@ -202,6 +328,7 @@ class Spectra(object):
 
 	def printPeaks(self):
 		if self.peaks and len(self.peaks) > 0:
+			import tabulate
 			header = ["Index"] + Peak.header()
 			rows = [[str(p_i)] + p.toRow() for p_i, p in enumerate(self.peaks, start=1)]
 			print(tabulate.tabulate(rows, header))
@@ -210,6 +337,8 @@ class Spectra(object):
 
 	def plot(self, xmax, ymax, title=None, to_screen=True, output_file=None):
 
+		import matplotlib.pyplot as plt
+
 		fig = plt.figure()
 
 		labels = []
@@ -282,11 +411,9 @@ class KmerSpectra(Spectra):
 		# Also double check the following two steps, rather than just the next one.
 		# Sometimes we can get a strange laddering affect in alternate frequencies which prevent
 		# us from correctly detecting the minima
-		fmin = 0
-		for i in range(1, len(self.histogram) - 2):
-			if self.histogram[i] < self.histogram[i + 1] and self.histogram[i] < self.histogram[i + 2]:
-				fmin = i
-				break
+		h = self.histogram
+		minima = np.flatnonzero((h[1:-2] < h[2:-1]) & (h[1:-2] < h[3:]))
+		fmin = int(minima[0]) + 1 if minima.size else 0
 
 		# Sometimes we might not find a local minima, it depends on what sort of content is in the spectra.
 		# In this case just reset all spectra measures
@@ -329,6 +456,17 @@ class KmerSpectra(Spectra):
 				radius = int(sigma * 2.0)
 				mean = int(mu)
 
+				# The theoretical position is only a coarse guess, so refine it to the highest point within one stddev
+				# (ignoring the error k-mers before fmin).  This gives the local optimisation a much better start.  If
+				# the highest point is on the edge of the window then we are just on the slope of some other content,
+				# so stick with the theoretical position.
+				lo = max(fmin + 1, int(mu - sigma))
+				hi = min(len(self.histogram), int(mu + sigma) + 1)
+				if hi - lo >= 3:
+					offset = int(np.argmax(self.histogram[lo:hi]))
+					if 0 < offset < hi - lo - 1:
+						mean = lo + offset
+
 				# Conditions:
 				# - we need at least a radius of 2
 				# - the peak frequency must be greater than fmin
@@ -356,25 +494,19 @@ class KmerSpectra(Spectra):
 		:param approx_freq: User provided guide for roughly where the homozygous peak should be located
 		:return: The 1-based index of the primary peak
 		"""
+		if not self.peaks:
+			return 0
+
+		means = np.fromiter((p.mean() for p in self.peaks), float, count=len(self.peaks))
+
 		if approx_freq > 0:
 			# User specified a particular frequency to look at, work out which peak is closest and label
 			# that the homozygous peak
-			min_peak_index = 0
-			delta_peak_freq = 1000000
-			for p_i, p in enumerate(self.peaks, start=1):
-				delta = abs(p.mean() - approx_freq)
-				if delta_peak_freq > delta:
-					delta_peak_freq = delta
-					min_peak_index = p_i
-			return min_peak_index
+			return int(np.argmin(np.abs(means - approx_freq))) + 1
 		else:
 			# No frequency given.  Use the primary peak (i.e. the one that represents the global maxima)
-			if self.peaks:
-				for i, p in enumerate(self.peaks, start=1):
-					if abs(p.mean() - self.fmax) < 4.0:
-						return i
-
-		return 0
+			matches = np.flatnonzero(np.abs(means - self.fmax) < 4.0)
+			return int(matches[0]) + 1 if matches.size else 0
 
 	def calcGenomeSize(self, hom_peak=0):
 		"""
@@ -390,16 +522,10 @@ class KmerSpectra(Spectra):
 		if hom_peak_index == 0:
 			return 0
 
-		sum = 0
-		for p_i, p in enumerate(self.peaks, start=1):
-			if p_i >= hom_peak_index:
-				delta = p_i - hom_peak_index + 1
-				sum += delta * p.elements()
-			elif p_i < hom_peak_index:
-				delta = hom_peak_index - p_i + 1
-				sum += p.elements() / delta
-
-		return int(sum)
+		elems = np.fromiter((p.elements() for p in self.peaks), float, count=len(self.peaks))
+		idx = np.arange(1, len(self.peaks) + 1)
+		delta = np.abs(idx - hom_peak_index) + 1
+		return int(np.where(idx >= hom_peak_index, delta * elems, elems / delta).sum())
 
 	def calcHetRate(self, genome_size=0, hom_peak=0):
 		"""
@@ -416,20 +542,18 @@ class KmerSpectra(Spectra):
 		if hom_peak_index < 2:
 			return 0.0
 
-		sum = 0
-		for p_i, p in enumerate(self.peaks, start=1):
-			# Skip the last peak
-			if p_i >= hom_peak_index:
-				break
-			sum += p.elements() / self.k
+		# Only the peaks before the homozygous peak count towards heterozygous content
+		elems = np.fromiter((p.elements() for p in self.peaks[:hom_peak_index - 1]), float, count=hom_peak_index - 1)
+		sum = elems.sum() / self.k
 
 		return (sum / genomesize) * 100.0
 
 	def calcKmerCoverage(self):
 		if self.peaks:
-			tot_vol = sum([x.elements() for x in self.peaks])
-			weighted = sum([x.mean() * x.elements() for x in self.peaks])
-			return int(weighted / tot_vol) if tot_vol > 0 else 0
+			elems = np.fromiter((p.elements() for p in self.peaks), float, count=len(self.peaks))
+			means = np.fromiter((p.mean() for p in self.peaks), float, count=len(self.peaks))
+			tot_vol = elems.sum()
+			return int((means * elems).sum() / tot_vol) if tot_vol > 0 else 0
 		else:
 			return 0
 
@@ -521,50 +645,39 @@ class GCSpectra(Spectra):
 
 	def _createInitialPeaks(self):
 		"""
-		Creates a set of peaks based on all maxima after taking the moving average of the histogram
+		Creates a set of peaks based on all sufficiently prominent maxima in the histogram
 		"""
 
-		#TODO May need to compensate for reduction in elements from moving average
-		wlen=3
-		smooth_histo = smooth(self.histogram, window_len=wlen)
+		# Find local maxima directly on the histogram.  Flat topped peaks are handled properly and requiring a minimum
+		# prominence stops small wobbles being picked up as peaks, each of which would otherwise cost us another
+		# gaussian in the optimisation.
+		prominence = max(1, self.histogram.max(initial=0) * 1e-3)
+		peak_means, _ = find_peaks(self.histogram, prominence=prominence, distance=2)
 
-		# for local maxima
-		peak_means = argrelextrema(smooth_histo, np.greater)
+		global_max = int(np.argmax(self.histogram)) if len(self.histogram) else -1
 
-		if not peak_means or len(peak_means) == 0:
+		peaks = []
 
-			# Not enough data to create peaks in this case.
-			self.peaks = None
+		for mean in peak_means:
 
-		else:
+			# Take a first guess at the std dev, just use something relatively narrow for now
+			# the local optimisation should pad this out later
+			sigma = 2.0
 
-			peaks = []
+			# We are (at present, only) interested in a region up to 2 stddevs from the mean (95% coverage)
+			radius = int(sigma * 2.0)
 
-			# Unless otherwise specified we assume fmax represents the homozygous peak (primary content)
-			# Explore expected peak sites, also look for heterozygous content.
-			for mu in peak_means[0]:
-
-				# Correct for smoothing
-				mean = mu - wlen + 2
-
-				# Take a first guess at the std dev, just use something relatively narrow for now
-				# the local optimisation should pad this out later
-				sigma = 2.0
-
-				# We are (at present, only) interested in a region up to 2 stddevs from the mean (95% coverage)
-				radius = int(sigma * 2.0)
-
-				# Ignore anything too close to the edge
-				if mean - radius > 0 and mean + radius < self.k:
-					# This code assumes a maxima exists here
-					peaks.append(Peak(
-						mean,		# Mean
-						sigma,  	# Std dev
-						self.histogram[mean], # Use the histogram value at this position as an initial value for this peak
-						mean == np.argmax(self.histogram)  # Whether or not this is the primary peak
-					))
+			# Ignore anything too close to the edge
+			if mean - radius > 0 and mean + radius < self.k:
+				# This code assumes a maxima exists here
+				peaks.append(Peak(
+					mean,		# Mean
+					sigma,  	# Std dev
+					self.histogram[mean], # Use the histogram value at this position as an initial value for this peak
+					mean == global_max  # Whether or not this is the primary peak
+				))
 
-			self.peaks = peaks
+		self.peaks = peaks
 
 		return
 
@@ -0,0 +1,138 @@
+import unittest
+import numpy as np
+from scipy import optimize
+
+from kat.peak import Peak
+from kat.spectra import KmerSpectra, _frequencyAxis, _sumGaussiansBroadcast, _sumGaussiansJit
+
+
+def central_difference(f, params, rel_step=1e-6):
+	"""
+	Finite difference estimate of the jacobian of f at params
+	"""
+	params = np.asarray(params, dtype=np.float64)
+	cols = []
+	for i in range(len(params)):
+		h = rel_step * max(abs(params[i]), 1.0)
+		up = params.copy()
+		down = params.copy()
+		up[i] += h
+		down[i] -= h
+		cols.append((f(up) - f(down)) / (2.0 * h))
+	return np.column_stack(cols)
+
+
+class SpectraTest(unittest.TestCase):
+
+	def two_peak_spectra(self):
+		"""
+		Synthetic histogram made of two gaussians plus some poisson noise, with a spectra ready to fit it
+		"""
+		truth = np.array([50.0, 1000.0, 6.0, 100.0, 400.0, 9.0])
+		x = np.arange(200, dtype=np.float64)
+		t = truth.reshape(-1, 3)
+		histogram = np.random.RandomState(7).poisson(_sumGaussiansBroadcast(x, t[:, 0], t[:, 1], t[:, 2], np.empty_like(x)))
+
+		s = KmerSpectra(histogram)
+		s.peaks = [Peak(51, 6.5, 1100.0, True), Peak(99, 8.5, 450.0, False)]
+		for p in s.peaks:
+			p.Tx = np.arange(len(histogram), dtype=np.float64)
+			p.Ty = np.zeros(len(histogram))
+		return s, truth
+
+	@unittest.skipIf(_sumGaussiansJit() is None, "numba not installed")
+	def test_sum_gaussians_jit_matches_broadcast(self):
+		x = _frequencyAxis(1000)
+		means = np.array([48.0, 97.5, 195.0, 290.25], dtype=np.float32)
+		peaks = np.array([1.2e4, 8.5e5, 3.1e4, 9.0e2], dtype=np.float32)
+		stddevs = np.array([7.0, 10.0, 14.5, 17.0], dtype=np.float32)
+
+		jit = _sumGaussiansJit()(x, means, peaks, stddevs, np.empty_like(x))
+		broadcast = _sumGaussiansBroadcast(x, means, peaks, stddevs, np.empty_like(x))
+
+		# Both work in single precision (and the jit with fastmath), so only expect agreement to float32 accuracy
+		np.testing.assert_allclose(jit, broadcast, rtol=1e-5, atol=1e-5 * broadcast.max())
+
+	def test_create_model_uses_given_axis(self):
+		s = KmerSpectra(np.zeros(100))
+		s.peaks = [Peak(150, 10.0, 5.0, True)]
+
+		# Same length as Tx but covering different frequencies, so must not be swapped for Tx
+		x = np.arange(100, 200, dtype=np.float64)
+		model = s._createModel(x, 150.0, 10.0, 5.0)
+		np.testing.assert_allclose(model, 10.0 * np.exp(-0.5 * ((x - 150.0) / 5.0) ** 2), rtol=1e-5, atol=1e-5)
+
+		# A float64 copy of Tx (as handed over by curve_fit) still gives the model over Tx
+		model = s._createModel(s.Tx.astype(np.float64), 50.0, 10.0, 5.0)
+		np.testing.assert_allclose(model, 10.0 * np.exp(-0.5 * ((s.Tx - 50.0) / 5.0) ** 2), rtol=1e-5, atol=1e-5)
+
+	def test_spectra_jacobian_matches_finite_difference(self):
+		histogram = np.zeros(300)
+		s = KmerSpectra(histogram)
+		s.peaks = [Peak(60, 8.0, 1000.0, True), Peak(120, 11.0, 200.0, False)]
+		params = np.array([61.3, 950.0, 7.6, 118.2, 230.0, 11.9])
+		x = np.arange(len(histogram), dtype=np.float64)
+
+		# _createModel evaluates in single precision, so difference the same model in double precision instead
+		def model(p):
+			p = p.reshape(-1, 3)
+			return _sumGaussiansBroadcast(x, p[:, 0], p[:, 1], p[:, 2], np.empty_like(x))
+
+		jac = s._createJacobian(x, *params)
+		np.testing.assert_allclose(jac, central_difference(model, params), rtol=1e-6, atol=1e-6 * np.abs(jac).max())
+
+	def test_peak_jacobian_matches_finite_difference(self):
+		p = Peak(10, 3.0, 500.0, True)
+		p.histogram = np.random.RandomState(1).poisson(100, 60).astype(np.float64)
+		p.Tx = np.arange(60, dtype=np.float64)
+		params = np.array([9.5, 480.0, 3.5])
+
+		# Use a non-zero fmin too, with the peak close enough to the start that the suppressed rows are significant
+		for fmin in (0, 4):
+			jac = p.jacobian(params, fmin)
+			fd = central_difference(lambda q: p.residuals(q, fmin), params)
+			np.testing.assert_allclose(jac, fd, rtol=1e-6, atol=1e-6 * np.abs(jac).max())
+
+			head = jac[:fmin + 1]
+			np.testing.assert_allclose(head, fd[:fmin + 1], rtol=1e-5, atol=1e-6 * np.abs(head).max())
+
+	def test_levenberg_marquardt_matches_curve_fit(self):
+		s, truth = self.two_peak_spectra()
+		y = s.histogram.astype(np.float64)
+		p0 = np.array([51.0, 900.0, 5.5, 99.0, 380.0, 9.5])
+		lower_bounds = np.array([49.0, 0.0, 3.0, 97.0, 0.0, 5.0])
+		# Cap the first peak below its true height so the bound is active and that parameter gets held
+		upper_bounds = np.array([53.0, 950.0, 12.0, 101.0, 1000.0, 14.0])
+
+		fitted = s._levenbergMarquardt(s.Tx, y, p0, lower_bounds, upper_bounds)
+		expected = optimize.curve_fit(s._createModel, s.Tx, y, p0=p0, bounds=(lower_bounds, upper_bounds),
+									  jac=s._createJacobian, method="trf", x_scale="jac")[0]
+
+		self.assertIsNotNone(fitted)
+		self.assertEqual(fitted[1], 950.0)
+		np.testing.assert_allclose(fitted, expected, rtol=1e-3)
+
+	def test_levenberg_marquardt_all_locked(self):
+		s, truth = self.two_peak_spectra()
+		y = s.histogram.astype(np.float64)
+		p0 = np.array([51.0, 900.0, 5.5, 99.0, 380.0, 9.5])
+
+		# No room to move anything, so the damping should run away and hand back the starting point
+		fitted = s._levenbergMarquardt(s.Tx, y, p0, p0.copy(), p0.copy())
+		np.testing.assert_array_equal(fitted, p0)
+
+	def test_optimise_falls_back_to_curve_fit(self):
+		s, truth = self.two_peak_spectra()
+		y = s.histogram.astype(np.float64)
+		p0 = np.array([51.0, 900.0, 5.5, 99.0, 380.0, 9.5])
+		lower_bounds = p0 - np.array([2.0, 900.0, 2.5, 2.0, 380.0, 4.5])
+		upper_bounds = p0 + np.array([2.0, 200.0, 6.0, 2.0, 200.0, 4.5])
+
+		# Not enough iterations to converge, so the caller is told to fall back
+		self.assertIsNone(s._levenbergMarquardt(s.Tx, y, p0, lower_bounds, upper_bounds, max_iter=1))
+
+		# ... which optimise() does, and still ends up with a sensible fit
+		s._levenbergMarquardt = lambda *args, **kwargs: None
+		s.optimise()
+		fitted = np.array([[p.mean(), p.peak(), p.stddev()] for p in s.peaks]).ravel()
+		np.testing.assert_allclose(fitted, truth, rtol=0.05)